@@ -1,8 +1,16 @@
 # generate a banner for the LAS Ecliptic
-import gzip
-import svgwrite
+import multiprocessing
+import os
+import zipfile
+import numpy as np
 
-from math import atan2, cos, pi, sin, sqrt
+try:
+    from isal import igzip as gzip  # much faster (de)compression, if python-isal is installed
+except ImportError:
+    import gzip
+
+from math import cos, pi, sin
+from pathlib import Path
 
 
 bkgr_attrs = {  # SVG attributes of background rectangle
@@ -17,6 +25,7 @@ eclpt_attrs = {  # SVG attributes of ecliptic line
 }
 
 line_attrs = {  # SVG attributes of figure lines
+    'fill': 'none',
     'stroke': '#f0e12c',  # from LAS logo
     'stroke-width': '0.75',
     'stroke-miterlimit': '4',
@@ -33,53 +42,146 @@ dwg_bleed_width = 8.5 * dwg_dpi  # width of paper, converted to dwg units
 dwg_border = 0.5 * dwg_dpi  # border in dwg units
 dwg_sky_width = dwg_bleed_width - 2 * dwg_border
 dwg_scale = dwg_sky_width / (2 * pi)  # scale for ecl lng --> dwg
+dwg_height = pi * dwg_scale  # ecl lat from pi/2 to -pi/2
+# coordinates are written with 2 decimals (1/10000 inch), star radii with 3 since they are small
+
+obl = 23.4376 * pi / 180  # true obliquity of the ecliptic for 1/1/2022
+cos_obl = cos(obl)
+sin_obl = sin(obl)
 
 
-def ecl_to_dwg(lng, lat, max_lng):  # convert ecliptic to drawing coordinates
+def make_projector(max_lng):  # make a function to convert ecliptic to drawing coordinates
     # ecliptic longitude decreases left to right on the chart
     # max_lng is on the left edge of the drawing, coordinate 0
-    return dwg_scale * (max_lng - lng), dwg_scale * (pi / 2 - lat)
+    dx0 = dwg_scale * max_lng  # constant terms, computed once per chart
+    dy0 = dwg_scale * pi / 2
+
+    def ecl_to_dwg(lng, lat):  # works on single values or arrays
+        return dx0 - dwg_scale * lng, dy0 - dwg_scale * lat
+    return ecl_to_dwg
+
+
+def equ_to_ecl(ra, dec):  # convert equatorial to ecliptic coordinates, works on arrays
+    cos_dec = np.cos(dec)
+    equx = cos_dec * np.cos(ra)  # equatorial x, y, z coordinates
+    equy = cos_dec * np.sin(ra)
+    equz = np.sin(dec)
+    eclx = equx  # ecliptic x, y, z coordinates
+    ecly = equy * cos_obl + equz * sin_obl
+    eclz = equz * cos_obl - equy * sin_obl
+    ecl_lng = np.arctan2(ecly, eclx)  # ecliptic longitude, radians
+    ecl_lat = np.arctan2(eclz, np.hypot(eclx, ecly))
+    return ecl_lng, ecl_lat
+
 
+def star_radius(vmag):  # size of dot on chart, works on arrays
+    return dwg_scale * (7 - np.minimum(6.5, 0.8 * vmag)) / 400
 
-class Star:
-    def __init__(self, hip_id=None, ra=None, dec=None, vmag=None):
+
+class StarTable:  # star data in parallel arrays, one row per star
+    __slots__ = ('hip_id', 'vmag', 'ecl_lng', 'ecl_lat', 'radius', 'idx')
+    fields = ('hip_id', 'vmag', 'ecl_lng', 'ecl_lat')  # the arrays passed in and cached
+
+    def __init__(self, hip_id, vmag, ecl_lng, ecl_lat):
         self.hip_id = hip_id
-        self.ra = ra
-        self.dec = dec
         self.vmag = vmag
-
-        equx = cos(self.dec) * cos(self.ra)  # equatorial x, y, z coordinates
-        equy = cos(self.dec) * sin(self.ra)
-        equz = sin(self.dec)
-        obl = 23.4376 * pi / 180  # true obliquity of the ecliptic for 1/1/2022
-        eclx = equx  # ecliptic x, y, z coordinates
-        ecly = equy * cos(obl) + equz * sin(obl)
-        eclz = equz * cos(obl) - equy * sin(obl)
-        self.ecl_lng = atan2(ecly, eclx)  # ecliptic longitude, radians
-        self.ecl_lat = atan2(eclz, sqrt(eclx ** 2 + ecly ** 2))
-        self.radius = dwg_scale * (7 - min(6.5, 0.8 * self.vmag)) / 400  # size of dot on chart
+        self.ecl_lng = ecl_lng  # radians
+        self.ecl_lat = ecl_lat
+        self.radius = star_radius(vmag)  # not cached, since it depends on the drawing scale
+        self.idx = {hip: i for i, hip in enumerate(hip_id.tolist())}  # HIP id --> row
+
+    def __len__(self):
+        return len(self.hip_id)
+
+
+hip_file_name = 'hip2.dat.gz'  # see README.md for source of data file
+hip_cache_name = 'hip2.cache.npz'  # computed star data, rebuilt when the catalog or settings change
+vmag_limit = 7.0  # for speed
+
+
+def parse_float(text):  # value of a catalog field, or nan if it is not a number
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def parse_column(text):  # convert an array of text fields to floats, nan where not a number
+    values = np.empty(len(text))
+    block = 4096  # each block is converted in one call, only a block with a bad field goes one by one
+    for start in range(0, len(text), block):
+        try:
+            values[start:start + block] = text[start:start + block].astype(float)
+        except ValueError:
+            values[start:start + block] = [parse_float(value) for value in text[start:start + block]]
+    return values
+
+
+def parse_hip_catalog():  # read the catalog and compute ecliptic coordinates, returns dict of arrays
+    # see README.md for source of record layout:
+    # HIP id at bytes 0-6, ra at 15-28, dec at 29-42 (radians), vmag at 129-136
+    columns = [(0, 6), (15, 28), (29, 42), (129, 136)]
+    record_end = columns[-1][1]
+    with gzip.open(hip_file_name, mode='rb') as hip_file:
+        data = hip_file.read()
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    # if all records have the same length, the file can be viewed directly as a 2D array of bytes
+    record_length = data.index(b'\n') + 1
+    records = None
+    if record_length > record_end and len(data) % record_length == 0:
+        records = np.frombuffer(data, dtype=np.uint8).reshape(-1, record_length)
+        if not (records[:, -1] == ord('\n')).all():
+            records = None
+    if records is None:  # otherwise pad the lines with spaces to a common length first
+        lines = data.splitlines()
+        width = max(record_end, max(len(line) for line in lines))
+        records = np.frombuffer(b''.join(line.ljust(width) for line in lines), dtype=np.uint8).reshape(-1, width)
+
+    fields = np.full((len(records), len(columns)), np.nan)  # blank or bad fields are left as nan
+    for j, (start, end) in enumerate(columns):
+        text = np.ascontiguousarray(records[:, start:end]).view(f'S{end - start}').ravel()
+        filled = ~(records[:, start:end] == ord(' ')).all(axis=1)
+        fields[filled, j] = parse_column(text[filled])
+    discarded = np.isnan(fields).any(axis=1)
+    for i in np.flatnonzero(discarded):
+        print(f'Discarding: {records[i, :48].tobytes()} ...')
+    print(f'{np.count_nonzero(discarded)} record(s) discarded')
+    fields = fields[~discarded]
+    fields = fields[fields[:, 3] <= vmag_limit]
+    fields = fields[np.argsort(fields[:, 0], kind='stable')]  # sort by HIP id once, for repeatability
+    ra = fields[:, 1]
+    dec = fields[:, 2]
+    vmag = fields[:, 3]
+    ecl_lng, ecl_lat = equ_to_ecl(ra, dec)  # convert all stars at once
+    return {
+        'hip_id': fields[:, 0].astype(int),
+        'vmag': vmag,
+        'ecl_lng': ecl_lng,
+        'ecl_lat': ecl_lat,
+    }
 
 
 def load_hip_catalog():
-    catalog = dict()  # HIP id --> Star
-    discarded = 0
-    vmag_limit = 7.0  # for speed
-    with gzip.open('hip2.dat.gz', mode='r') as hip_file:  # see README.md for source of data file
-        for line in hip_file:
-            try:
-                hip_id = int(line[0:6].strip())  # see README.md for source of record layout
-                ra = float(line[15:28].strip())  # radians
-                dec = float(line[29:42].strip())
-                vmag = float(line[129:136].strip())
-            except ValueError:
-                print(f'Discarding: {line[:48]} ...')
-                discarded += 1
-                continue
-            if vmag > vmag_limit:
-                continue
-            catalog[hip_id] = Star(hip_id=hip_id, vmag=vmag, ra=ra, dec=dec)
     print('HIP catalog:')
-    print(f'{discarded} record(s) discarded')
+    settings = {'obl': obl, 'vmag_limit': vmag_limit}  # the cached data depends on these
+    arrays = None
+    if os.path.exists(hip_cache_name) and os.path.getmtime(hip_cache_name) > os.path.getmtime(hip_file_name):
+        try:
+            with np.load(hip_cache_name) as cache:
+                if all(key in cache.files and cache[key] == value for key, value in settings.items()):
+                    arrays = {key: cache[key] for key in StarTable.fields}
+                    print(f'read from {hip_cache_name}')
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile) as e:  # e.g. left by an interrupted run
+            print(f'{hip_cache_name} is damaged ({e}), rebuilding it')
+    if arrays is None:
+        arrays = parse_hip_catalog()
+        # write to a temporary file first, so an interrupted run cannot leave a partial cache
+        temp_name = hip_cache_name + '.tmp'
+        with open(temp_name, 'wb') as cache_file:
+            np.savez_compressed(cache_file, **arrays, **settings)
+        os.replace(temp_name, hip_cache_name)
+    catalog = StarTable(**arrays)
     print(f'{len(catalog)} records loaded')
     print()
     return catalog
@@ -93,20 +195,16 @@ def get_figures():
             line = line.strip()
             if line == '' or line[0] == '#':
                 continue
-            fields = line.split()
-            name = fields.pop(0)
-            count = int(fields.pop(0))
-            fig = list()
-            for i in range(count):
-                id1 = int(fields.pop(0))
-                id2 = int(fields.pop(0))
-                fig.append((id1, id2))
-                stars_present.add(id1)
-                stars_present.add(id2)
-            if len(fields) > 0:
-                print('extra data found in a line of figures file:')
+            name, count, *ids = line.split()
+            ids = [int(hip_id) for hip_id in ids]
+            n = 2 * int(count)  # two HIP ids for each line segment
+            if len(ids) != n:
+                print('extra data found in a line of figures file:' if len(ids) > n
+                      else 'missing data in a line of figures file:')
                 print(line)
                 break
+            fig = list(zip(ids[0::2], ids[1::2]))
+            stars_present.update(ids)
             figures[name] = fig
     print('figure file:')
     print(f'{len(figures)} figures loaded')
@@ -115,46 +213,140 @@ def get_figures():
     return figures, stars_present
 
 
+morse_alphabet = {'a': '.-', 'b': '-...', 'c': '-.-.', 'd': '-..', 'e': '.', 'f': '..-.',
+                  'g': '--.', 'h': '....', 'i': '..', 'j': '.---', 'k': '-.-', 'l': '.-..',
+                  'm': '--', 'n': '-.', 'o': '---', 'p': '.--.', 'q': '--.-', 'r': '.-.',
+                  's': '...', 't': '-', 'u': '..-', 'v': '...-', 'w': '.--', 'x': '-..-',
+                  'y': '-.--', 'z': '--..', '1': '.----', '2': '..---', '3': '...--',
+                  '4': '....-', '5': '.....', '6': '-....', '7': '--...', '8': '---..',
+                  '9': '----.', '0': '-----', ', ': '--..--', '.': '.-.-.-', '?': '..--..',
+                  '/': '-..-.', '-': '-....-', '(': '-.--.', ')': '-.--.-'
+                  }
+
+
+def morse_char(code):  # line segments of one character relative to its start, and its total length
+    segments = list()
+    x = 0
+    for symbol in code:
+        if symbol == '-':
+            segments.append((x, x + 3))
+            x += 5  # lengths and spaces are not standard Morse, but look good
+        else:
+            segments.append((x, x + 1))
+            x += 3
+    return tuple(segments), x + 3
+
+
+morse_chars = {ch: morse_char(code) for ch, code in morse_alphabet.items()}  # computed once at load
+morse_chars[' '] = ((), 6)
+
+
 def morse_coords(string, minc, maxc):  # convert a string to a list of line segment coords
-    alphabet = {'a': '.-', 'b': '-...', 'c': '-.-.', 'd': '-..', 'e': '.', 'f': '..-.',
-                'g': '--.', 'h': '....', 'i': '..', 'j': '.---', 'k': '-.-', 'l': '.-..',
-                'm': '--', 'n': '-.', 'o': '---', 'p': '.--.', 'q': '--.-', 'r': '.-.',
-                's': '...', 't': '-', 'u': '..-', 'v': '...-', 'w': '.--', 'x': '-..-',
-                'y': '-.--', 'z': '--..', '1': '.----', '2': '..---', '3': '...--',
-                '4': '....-', '5': '.....', '6': '-....', '7': '--...', '8': '---..',
-                '9': '----.', '0': '-----', ', ': '--..--', '.': '.-.-.-', '?': '..--..',
-                '/': '-..-.', '-': '-....-', '(': '-.--.', ')': '-.--.-'
-                }
     coords = list()
     x = 0.0
     for ch in string.strip():
-        if ch == ' ':
-            x += 6
-        else:
-            code = alphabet[ch]
-            for symbol in code:
-                if symbol == '-':
-                    coords.append((x, x + 3))
-                    x += 5  # lengths and spaces are not standard Morse, but look good
-                else:
-                    coords.append((x, x + 1))
-                    x += 3
-            x += 3
+        segments, length = morse_chars[ch]
+        coords.extend((x + x1, x + x2) for x1, x2 in segments)
+        x += length
     scale = (maxc - minc) / (x - 2)
     return list([(x1 * scale + minc, x2 * scale + minc) for x1, x2 in coords])
 
 
-def make_svg_layer(dwg, name):  # create SVG group
-    group = dwg.g(id=name.lower())
-    # the following will make it look like an Inkscape layer
+def svg_attrs(attrs):  # format a dict of SVG attributes for writing into a tag
+    return ' '.join(f'{key}="{value}"' for key, value in attrs.items())
+
+
+def make_svg_layer(name, attrs=''):  # opening tag of an SVG group, to be closed with '</g>'
+    # attrs is a string of formatted attributes, inherited by all elements in the group
+    # adding the following will make it look like an Inkscape layer
     # but it needs more boilerplate at the document level to load cleanly
-    # group.update({
-    #     'inkscape:groupmode': 'layer',
-    #     'inkscape:label': name,
-    #     'style': 'display:inline',
-    # })
-    dwg.add(group)
-    return group
+    # inkscape:groupmode="layer" inkscape:label="{name}" style="display:inline"
+    return f'<g id="{name.lower()}" {attrs}>' if attrs else f'<g id="{name.lower()}">'
+
+
+svg_header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              f'<svg baseProfile="tiny" version="1.2" width="{dwg_bleed_width}" height="{dwg_height}" '
+              'xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">')
+bkgr_svg = svg_attrs(bkgr_attrs)  # format the attributes once
+line_svg = svg_attrs(line_attrs)
+star_svg = svg_attrs(star_attrs)
+eclpt_svg = svg_attrs(eclpt_attrs)
+
+chart_data = dict()  # data shared by all charts, set in each worker process by init_chart_worker()
+
+
+def init_chart_worker(data):
+    chart_data.update(data)
+
+
+def make_chart_bytes(anchor_name):  # SVG text of the chart with the given zodiac figure as the leftmost one
+    zodiac = chart_data['zodiac']
+    fig_coords = chart_data['fig_coords']
+    fig_max_lng = chart_data['fig_max_lng']
+    star_lng = chart_data['star_lng']
+    star_lat = chart_data['star_lat']
+    star_rad = chart_data['star_rad']
+
+    max_lng = fig_max_lng[anchor_name] + dwg_border / dwg_scale
+    ecl_to_dwg = make_projector(max_lng)
+
+    # the SVG is built directly as text, which is much faster than building an element tree
+    parts = [svg_header]
+
+    parts.append(make_svg_layer('Background'))
+    parts.append(f'<rect x="0" y="0" width="{dwg_bleed_width}" height="{dwg_height}" {bkgr_svg}/>')
+    parts.append('</g>')
+
+    parts.append(make_svg_layer('Figures', line_svg))
+    for name in zodiac:  # one path per figure, with a move and a line for each segment
+        figure = fig_coords[name]
+        offset = -2 * pi if fig_max_lng[name] > fig_max_lng[anchor_name] else 0.0
+        path = list()
+        for line in figure:
+            pair1, pair2 = line
+            ex1, ey1 = pair1
+            ex1 += offset
+            ex2, ey2 = pair2
+            ex2 += offset
+            dx1, dy1 = ecl_to_dwg(ex1, ey1)
+            dx2, dy2 = ecl_to_dwg(ex2, ey2)
+            path.append('M%.2f %.2fL%.2f %.2f' % (dx1, dy1, dx2, dy2))
+        parts.append(f'<path d="{"".join(path)}"/>')
+    parts.append('</g>')
+
+    parts.append(make_svg_layer('Stars', star_svg))
+    # shift every star by the multiple of 2 pi that puts it within one turn right of the left edge
+    lng = star_lng + 2 * pi * np.floor((max_lng - star_lng) / (2 * pi))
+    lat = star_lat
+    rad = star_rad
+    for _ in range(2):  # stars near the left edge are drawn again one turn right, to fill in the border
+        dx, dy = ecl_to_dwg(lng, lat)  # all stars at once
+        visible = (0.0 < dx) & (dx < dwg_bleed_width)
+        for dx1, dy1, radius in zip(dx[visible].tolist(), dy[visible].tolist(), rad[visible].tolist()):
+            parts.append('<circle cx="%.2f" cy="%.2f" r="%.3f"/>' % (dx1, dy1, radius))
+        near = dx < dwg_bleed_width - dwg_sky_width
+        lng = lng[near] - 2 * pi
+        lat = lat[near]
+        rad = rad[near]
+    parts.append('</g>')
+
+    parts.append(make_svg_layer('Ecliptic', eclpt_svg))
+    x, y = ecl_to_dwg(0.0, 0.0)
+    coords = morse_coords('the ecliptic -- lackawanna astronomical society', dwg_border,
+                          dwg_bleed_width - dwg_border)
+    for x1, x2 in coords:
+        parts.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f"/>' % (x1, y, x2, y))
+    parts.append('</g>')
+
+    parts.append('</svg>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_chart(anchor_name):  # make a chart file with the given zodiac figure as the leftmost one
+    filename = f'ecliptic_chart_beginning_with_{anchor_name.lower()}.svgz'  # gzip-compressed SVG
+    # mtime=0 leaves the time out of the gzip header, so unchanged charts give identical files
+    Path(filename).write_bytes(gzip.compress(make_chart_bytes(anchor_name), mtime=0))  # compress and write at once
+    return filename
 
 
 def main():
@@ -174,9 +366,9 @@ def main():
         for pair in id_pairs:
             coord_pair = list()
             for hip_id in pair:
-                star = hip_catalog[hip_id]
-                lng = star.ecl_lng
-                lat = star.ecl_lat
+                i = hip_catalog.idx[hip_id]
+                lng = float(hip_catalog.ecl_lng[i])
+                lat = float(hip_catalog.ecl_lat[i])
                 coord_pair.append([lng, lat])
                 min_lng = min(min_lng, lng)
                 max_lng = max(max_lng, lng)
@@ -192,49 +384,30 @@ def main():
         fig_coords[name] = coord_pairs
         fig_max_lng[name] = max_lng
 
-    for anchor_name in sorted(zodiac):  # make a chart with each zodiac figure as the leftmost one
-        filename = f'ecliptic_chart_beginning_with_{anchor_name.lower()}.svg'
-        max_lng = fig_max_lng[anchor_name] + dwg_border / dwg_scale
-
-        dwg = svgwrite.Drawing(filename, profile='tiny', size=(dwg_bleed_width, pi * dwg_scale), debug=False)
-
-        group = make_svg_layer(dwg, 'Background')
-        group.add(dwg.rect(insert=(0, 0), size=(dwg_bleed_width, pi * dwg_scale), **bkgr_attrs))
-
-        group = make_svg_layer(dwg, 'Figures')
-        for name in zodiac:
-            figure = fig_coords[name]
-            offset = -2 * pi if fig_max_lng[name] > fig_max_lng[anchor_name] else 0.0
-            for line in figure:
-                pair1, pair2 = line
-                ex1, ey1 = pair1
-                ex1 += offset
-                ex2, ey2 = pair2
-                ex2 += offset
-                dx1, dy1 = ecl_to_dwg(ex1, ey1, max_lng)
-                dx2, dy2 = ecl_to_dwg(ex2, ey2, max_lng)
-                group.add(dwg.line((dx1, dy1), (dx2, dy2), **line_attrs))
-
-        group = make_svg_layer(dwg, 'Stars')
-        for hip_id in sorted(hip_catalog.keys()):  # sorting for repeatability
-            star = hip_catalog[hip_id]
-            for offset in (-2 * pi, 0, 2 * pi):  # draw star possibly multiple times to fill in borders
-                ex1 = star.ecl_lng + offset
-                ey1 = star.ecl_lat
-                dx1, dy1 = ecl_to_dwg(ex1, ey1, max_lng)
-                if 0.0 < dx1 < dwg_bleed_width:
-                    if star.vmag < 3.5 or star.hip_id in stars_present:
-                        group.add(dwg.circle((dx1, dy1), star.radius, **star_attrs))
-
-        group = make_svg_layer(dwg, 'Ecliptic')
-        x, y = ecl_to_dwg(0.0, 0.0, max_lng)
-        coords = morse_coords('the ecliptic -- lackawanna astronomical society', dwg_border,
-                              dwg_bleed_width - dwg_border)
-        for x1, x2 in coords:
-            group.add(dwg.line((x1, y), (x2, y), **eclpt_attrs))
-
-        dwg.save()
-        print(f'Created {filename}')
+    # coordinates of the stars to draw (bright or in figures), computed once for all charts
+    drawn = (hip_catalog.vmag < 3.5) | np.isin(hip_catalog.hip_id, list(stars_present))
+    star_lng = hip_catalog.ecl_lng[drawn]
+    star_lat = hip_catalog.ecl_lat[drawn]
+    star_rad = hip_catalog.radius[drawn]
+
+    data = {
+        'zodiac': zodiac,
+        'fig_coords': fig_coords,
+        'fig_max_lng': fig_max_lng,
+        'star_lng': star_lng,
+        'star_lat': star_lat,
+        'star_rad': star_rad,
+    }
+    # the charts are independent, so make them in parallel if there is more than one CPU
+    processes = min(len(zodiac), os.cpu_count() or 1)
+    if processes == 1:
+        init_chart_worker(data)
+        for filename in map(make_chart, sorted(zodiac)):
+            print(f'Created {filename}')
+    else:
+        with multiprocessing.Pool(processes, initializer=init_chart_worker, initargs=(data,)) as pool:
+            for filename in pool.imap(make_chart, sorted(zodiac)):
+                print(f'Created {filename}')
 
 
 if __name__ == '__main__':